@@ -7,8 +7,12 @@
 module tb ();
 
   // Dump the signals to a VCD file. You can view it with gtkwave or surfer.
+  // Pass +dumpfile=<name> to dump somewhere other than tb.vcd.
+  reg [8*64-1:0] dumpfile;
   initial begin
-    $dumpfile("tb.vcd");
+    if (!$value$plusargs("dumpfile=%s", dumpfile))
+      dumpfile = "tb.vcd";
+    $dumpfile(dumpfile);
     $dumpvars(0, tb);
     #1;
   end
@@ -27,6 +31,29 @@ module tb ();
   wire VGND = 1'b0;
 `endif
 
+  // 10 MHz (100 ns period) system clock, generated here rather than by a cocotb Clock
+  initial begin
+    clk = 1'b0;
+    forever #50 clk = ~clk;
+  end
+
+  // SPI clock generator: toggles SCLK at 100 kHz while nCS (ui_in[2]) is held
+  // low, so the cocotb test only has to drive nCS and COPI.
+  localparam SCLK_HALF_PERIOD = 5000;  // 5 us
+  reg internal_sclk;
+  initial internal_sclk = 1'b0;
+  always begin
+    wait (!ui_in[2]);
+    #(SCLK_HALF_PERIOD);
+    internal_sclk = !ui_in[2] && !internal_sclk;
+  end
+
+  // Mux the generated SCLK into ui_in[0] during a transaction
+  wire [7:0] ui_in_dut = {ui_in[7:1], ui_in[2] ? ui_in[0] : internal_sclk};
+
+  // Single-bit tap of the first PWM output, edge triggers need a 1-bit signal
+  wire pwm_out = uo_out[0];
+
   // Replace tt_um_example with your module name:
   tt_um_uwasic_onboarding_sam_barnes user_project (
 
@@ -36,7 +63,7 @@ module tb ();
       .VGND(VGND),
 `endif
 
-      .ui_in  (ui_in),    // Dedicated inputs
+      .ui_in  (ui_in_dut),  // Dedicated inputs
       .uo_out (uo_out),   // Dedicated outputs
       .uio_in (uio_in),   // IOs: Input path
       .uio_out(uio_out),  // IOs: Output path
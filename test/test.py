@@ -1,26 +1,48 @@
 # SPDX-FileCopyrightText: © 2024 Tiny Tapeout
 # SPDX-License-Identifier: Apache-2.0
 
+from functools import lru_cache
+
 import cocotb
-from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge
+from cocotb.triggers import FallingEdge
 from cocotb.triggers import ClockCycles
+from cocotb.triggers import Timer
+from cocotb.triggers import First
+from cocotb.triggers import ReadOnly
 from cocotb.types import Logic
 from cocotb.types import LogicArray
+from cocotb.utils import get_sim_time
 
-async def await_half_sclk(dut):
-    """Wait for the SCLK signal to go high or low."""
-    start_time = cocotb.utils.get_sim_time(units="ns")
-    while True:
-        await ClockCycles(dut.clk, 1)
-        # Wait for half of the SCLK period (10 us)
-        if (start_time + 100*100*0.5) < cocotb.utils.get_sim_time(units="ns"):
-            break
-    return
+# ui_in with nCS high, COPI and SCLK low
+UI_IN_IDLE = 0b100
 
-def ui_in_logicarray(ncs, bit, sclk):
-    """Setup the ui_in value as a LogicArray."""
-    return LogicArray(f"00000{ncs}{bit}{sclk}")
+async def reset_dut(dut):
+    """Enable the design, idle the SPI inputs and pulse rst_n."""
+    dut._log.info("Reset")
+    # Nothing is waiting on these yet, so skip the scheduled write path
+    dut.ena.setimmediatevalue(1)
+    dut.ui_in.setimmediatevalue(UI_IN_IDLE)
+    dut.rst_n.setimmediatevalue(0)
+    await ClockCycles(dut.clk, 5)
+    # Release reset through the scheduler so it stays aligned to the clock edge
+    dut.rst_n.value = 1
+    await Timer(500, units="ns")
+
+async def await_pwm_edge(edge):
+    """Wait for a PWM output edge, failing the test if none arrives within a second."""
+    timeout = Timer(10 ** 9, units="ns")
+    fired = await First(edge, timeout)
+    assert fired is not timeout, "Timed out waiting for PWM edge"
+
+@lru_cache(maxsize=None)
+def spi_ui_stream(r_w, address, data):
+    """
+    Pre-encode the ui_in value driven for each of the 16 SPI bits, MSB first.
+    nCS is low and SCLK comes from the testbench, so only COPI (ui_in[1]) varies.
+    """
+    word = (((int(r_w) << 7) | address) << 8) | data
+    return bytes(((word >> (15-i)) & 0x1) << 1 for i in range(16))
 
 async def send_spi_transaction(dut, r_w, address, data):
     """
@@ -33,6 +55,9 @@ async def send_spi_transaction(dut, r_w, address, data):
     - r_w: boolean, True for write, False for read
     - address: int, 7-bit address (0-127)
     - data: LogicArray or int, 8-bit data
+
+    ui_in is written as a plain int: Python only drives ui_in[2] = nCS and
+    ui_in[1] = COPI, the testbench generates SCLK and the other bits stay 0.
     """
     # Convert data to int if it's a LogicArray
     if isinstance(data, LogicArray):
@@ -44,108 +69,66 @@ async def send_spi_transaction(dut, r_w, address, data):
         raise ValueError("Address must be 7-bit (0-127)")
     if data_int < 0 or data_int > 255:
         raise ValueError("Data must be 8-bit (0-255)")
-    # Combine RW and address into first byte
-    first_byte = (int(r_w) << 7) | address
-    # Start transaction - pull CS low
-    sclk = 0
-    ncs = 0
-    bit = 0
-    # Set initial state with CS low
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
+    # Start transaction - pull CS low, the testbench then generates SCLK
+    prev_ui_in = 0
+    dut.ui_in.value = prev_ui_in
     await ClockCycles(dut.clk, 1)
-    # Send first byte (RW + Address)
-    for i in range(8):
-        bit = (first_byte >> (7-i)) & 0x1
-        # SCLK low, set COPI
-        sclk = 0
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-        # SCLK high, keep COPI
-        sclk = 1
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-    # Send second byte (Data)
-    for i in range(8):
-        bit = (data_int >> (7-i)) & 0x1
-        # SCLK low, set COPI
-        sclk = 0
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-        # SCLK high, keep COPI
-        sclk = 1
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
+    # Send RW + address byte followed by data byte
+    for ui_in in spi_ui_stream(r_w, address, data_int):
+        # Set COPI while SCLK is low, the testbench drives the clock edges,
+        # so ui_in only needs writing when COPI actually changes
+        if ui_in != prev_ui_in:
+            dut.ui_in.value = ui_in
+            prev_ui_in = ui_in
+        await RisingEdge(dut.internal_sclk)
+        await FallingEdge(dut.internal_sclk)
     # End transaction - return CS high
-    sclk = 0
-    ncs = 1
-    bit = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    await ClockCycles(dut.clk, 600)
-    return ui_in_logicarray(ncs, bit, sclk)
+    dut.ui_in.value = UI_IN_IDLE
+    # Give the DUT 600 clock cycles (60 us) to see CS high, nothing is sampled meanwhile
+    await Timer(60000, units="ns")
+    return UI_IN_IDLE
 
 @cocotb.test()
 async def test_spi(dut):
     dut._log.info("Start SPI test")
 
-    # Set the clock period to 100 ns (10 MHz)
-    clock = Clock(dut.clk, 100, units="ns")
-    cocotb.start_soon(clock.start())
-
-    # Reset
-    dut._log.info("Reset")
-    dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
+    await reset_dut(dut)
 
     dut._log.info("Test project behavior")
     dut._log.info("Write transaction, address 0x00, data 0xF0")
     ui_in_val = await send_spi_transaction(dut, 1, 0x00, 0xF0)  # Write transaction
+    await ReadOnly()  # Sample the settled output values
     assert dut.uo_out.value == 0xF0, f"Expected 0xF0, got {dut.uo_out.value}"
-    await ClockCycles(dut.clk, 1000) 
+    await ClockCycles(dut.clk, 1)  # Leave the read-only phase before writing again
 
     dut._log.info("Write transaction, address 0x01, data 0xCC")
     ui_in_val = await send_spi_transaction(dut, 1, 0x01, 0xCC)  # Write transaction
+    await ReadOnly()
     assert dut.uio_out.value == 0xCC, f"Expected 0xCC, got {dut.uio_out.value}"
-    await ClockCycles(dut.clk, 100)
+    await Timer(10000, units="ns")  # 100 clock cycles
 
     dut._log.info("Write transaction, address 0x30 (invalid), data 0xAA")
     ui_in_val = await send_spi_transaction(dut, 1, 0x30, 0xAA)
-    await ClockCycles(dut.clk, 100)
+    await Timer(10000, units="ns")  # 100 clock cycles
 
     dut._log.info("Read transaction (invalid), address 0x00, data 0xBE")
     ui_in_val = await send_spi_transaction(dut, 0, 0x30, 0xBE)
+    await ReadOnly()
     assert dut.uo_out.value == 0xF0, f"Expected 0xF0, got {dut.uo_out.value}"
-    await ClockCycles(dut.clk, 100)
+    await Timer(10000, units="ns")  # 100 clock cycles
     
     dut._log.info("Read transaction (invalid), address 0x41 (invalid), data 0xEF")
     ui_in_val = await send_spi_transaction(dut, 0, 0x41, 0xEF)
-    await ClockCycles(dut.clk, 100)
+    await Timer(10000, units="ns")  # 100 clock cycles
 
     dut._log.info("Write transaction, address 0x02, data 0xFF")
     ui_in_val = await send_spi_transaction(dut, 1, 0x02, 0xFF)  # Write transaction
-    await ClockCycles(dut.clk, 100)
-
-    dut._log.info("Write transaction, address 0x04, data 0xCF")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0xCF)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
-
-    dut._log.info("Write transaction, address 0x04, data 0xFF")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0xFF)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await Timer(10000, units="ns")  # 100 clock cycles
 
-    dut._log.info("Write transaction, address 0x04, data 0x00")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0x00)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
-
-    dut._log.info("Write transaction, address 0x04, data 0x01")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0x01)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    for duty in (0xCF, 0xFF, 0x00, 0x01):
+        dut._log.info("Write transaction, address 0x04, data 0x%02X", duty)
+        ui_in_val = await send_spi_transaction(dut, 1, 0x04, duty)  # Write transaction
+        await Timer(3000000, units="ns")  # 30000 clock cycles
 
     dut._log.info("SPI test completed successfully")
 
@@ -157,57 +140,19 @@ async def test_pwm_freq(dut):
 
     dut._log.info("Start PWM freq test")
 
-    clock = Clock(dut.clk, 100, units="ns") # 10MHz clock
-    cocotb.start_soon(clock.start())
-
-    # Reset
-    dut._log.info("Reset")
-    dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
-
-    s_to_ns = 10 ** 9 # Seconds in nano seconds
+    await reset_dut(dut)
 
     await send_spi_transaction(dut, 1, 0x00, 0x01) # Enable outputs
     await send_spi_transaction(dut, 1, 0x02, 0x01) # Enable PWM
     await send_spi_transaction(dut, 1, 0x04, 0x80) # Set duty cycle to 50%
 
-    test_start_time = cocotb.utils.get_sim_time(units="ns")
-
-
-    # Check falling edge of clock
-    while dut.uo_out.value != 0:
-        await ClockCycles(dut.clk, 1)
-        if (cocotb.utils.get_sim_time(units="ns") - test_start_time > s_to_ns):
-            return -1 # Timed out over a second
-        
-    
-    # Check rising edge of clock to determine start time of sample
-    while dut.uo_out.value == 0:
-        await ClockCycles(dut.clk, 1)
-        if (cocotb.utils.get_sim_time(units="ns") - test_start_time > s_to_ns):
-            return -1 # Timed out over a second
-        
-    sample_start_time = cocotb.utils.get_sim_time(units="ns")
-
-    # Waiting for falling edge to sample period
-    while dut.uo_out.value:
-        await ClockCycles(dut.clk, 1)
-    
-    
-    # Waiting for rising edge to sample period
-    while not dut.uo_out.value:
-        await ClockCycles(dut.clk, 1)
-
+    # RisingEdge only fires on a 0 -> 1 transition, so two of them bound one full period
+    await await_pwm_edge(RisingEdge(dut.pwm_out))
+    sample_start_time = get_sim_time(units="ns")
+    await await_pwm_edge(RisingEdge(dut.pwm_out))
 
-    frequency = (10 ** 9) / ((cocotb.utils.get_sim_time(units="ns") - sample_start_time))
-    dut._log.info(f'Frequency = {frequency} Hz')
+    frequency = (10 ** 9) / ((get_sim_time(units="ns") - sample_start_time))
+    dut._log.info('Frequency = %s Hz', frequency)
 
 
     assert frequency >= 2970 and frequency <= 3030, 'Frequency test fail, not between 2970 and 3030 Hz'
@@ -225,108 +170,39 @@ async def test_pwm_duty(dut):
     dut._log.info("Start PWM duty cycle test")
 
     
-    # Set the clock period to 100 ns (10 MHz)
-    clock = Clock(dut.clk, 100, units="ns")
-    cocotb.start_soon(clock.start())
-
-    s_to_ns = 10 ** 9 # Seconds in nano seconds
-
-    # Reset
-    dut._log.info("Reset")
-    dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
+    await reset_dut(dut)
 
     await send_spi_transaction(dut, 1, 0x00, 0x01) # Enable outputs
     await send_spi_transaction(dut, 1, 0x02, 0x01) # Enable PWM
     await send_spi_transaction(dut, 1, 0x04, 0x80) # Set duty cycle to 50%
 
-    test_start_time = cocotb.utils.get_sim_time(units="ns")
-
-
-    # Check falling edge of clock
-    while dut.uo_out.value != 0:
-        await ClockCycles(dut.clk, 1)
-        if (cocotb.utils.get_sim_time(units="ns") - test_start_time > s_to_ns):
-            return -1 # Timed out over a second
-        
-    
-    # Check rising edge of clock to determine start time of sample
-    while dut.uo_out.value == 0:
-        await ClockCycles(dut.clk, 1)
-        if (cocotb.utils.get_sim_time(units="ns") - test_start_time > s_to_ns):
-            return -1 # Timed out over a second
-        
-    sample_start_time = cocotb.utils.get_sim_time(units="ns")
-
-    # Waiting for falling edge to sample period
-    while dut.uo_out.value:
-        await ClockCycles(dut.clk, 1)
-    
-    
-    # Waiting for rising edge to sample period
-    while not dut.uo_out.value:
-        await ClockCycles(dut.clk, 1)
-
-    period = cocotb.utils.get_sim_time(units="ns") - sample_start_time
-
     # Testing 50% duty cycle
-
-    # Test start time at rising edge
-    sample_start_time = cocotb.utils.get_sim_time(units="ns")
-    s_to_ns = 10 ** 9 # Seconds in nano seconds
-
-    # Check falling edge of clock
-    while dut.uo_out.value != 0:
-        await ClockCycles(dut.clk, 1)
-        if (cocotb.utils.get_sim_time(units="ns") - sample_start_time > s_to_ns):
-            return -1 # Timed out over a second
-        
-    
-    # Check rising edge of clock to determine start time of sample
-    while dut.uo_out.value == 0:
-        await ClockCycles(dut.clk, 1)
-        if (cocotb.utils.get_sim_time(units="ns") - sample_start_time > s_to_ns):
-            return -1 # Timed out over a second
-
-    sample_start_time = cocotb.utils.get_sim_time(units="ns")
-
-    # Start after falling edge
-    while dut.uo_out.value:
-        await ClockCycles(dut.clk, 1)
-
-    sampled_period = cocotb.utils.get_sim_time(units="ns") - sample_start_time
+    # Rising edge starts the sample, the falling edge ends the high time and
+    # the next rising edge ends the period
+    await await_pwm_edge(RisingEdge(dut.pwm_out))
+    sample_start_time = get_sim_time(units="ns")
+    await await_pwm_edge(FallingEdge(dut.pwm_out))
+    sampled_period = get_sim_time(units="ns") - sample_start_time
+    await await_pwm_edge(RisingEdge(dut.pwm_out))
+    period = get_sim_time(units="ns") - sample_start_time
 
     ds = (sampled_period / period) * 100
 
-    dut.log.info('Duty cycle is ' + str(ds) + '%, should be 50%')
+    dut._log.info('Duty cycle is %s%%, should be 50%%', ds)
     assert ds == 50, 'Duty cycle is not 50%, ' + str(ds)
 
-    # Testing 0% duty cycle
+    # Testing 0% duty cycle, output must start low and never rise within 10 us
     await send_spi_transaction(dut, 1, 0x04, 0x00)
-    test_start_time = cocotb.utils.get_sim_time(units='ns')
-    
-    while dut.uo_out.value == 0:
-        await ClockCycles(dut.clk, 1)
-        if (dut.uo_out.value != 0):
-            assert not dut.uo_out.value, 'Signal high for 0 percent duty cycle'
-        if (cocotb.utils.get_sim_time(units="ns") - test_start_time > 10 ** 4):
-            break
-    
-    await send_spi_transaction(dut, 1, 0x04, 0xFF) # 100% duty cycle
-    test_start_time = cocotb.utils.get_sim_time(units='ns')
-
-    while dut.uo_out.value != 0:
-        await ClockCycles(dut.clk, 1)
-        if (not dut.uo_out.value):
-            assert dut.uo_out.value, 'Signal low for 100 percent duty cycle'
-        if (cocotb.utils.get_sim_time(units='ns') - test_start_time > 10 ** 4):
-            break
+    assert dut.pwm_out.value == 0, 'Signal high for 0 percent duty cycle'
+    window = Timer(10 ** 4, units="ns")
+    fired = await First(RisingEdge(dut.pwm_out), window)
+    assert fired is window, 'Signal high for 0 percent duty cycle'
+
+    # Testing 100% duty cycle, output must start high and never fall within 10 us
+    await send_spi_transaction(dut, 1, 0x04, 0xFF)
+    assert dut.pwm_out.value == 1, 'Signal low for 100 percent duty cycle'
+    window = Timer(10 ** 4, units="ns")
+    fired = await First(FallingEdge(dut.pwm_out), window)
+    assert fired is window, 'Signal low for 100 percent duty cycle'
 
     dut._log.info("PWM Duty Cycle test completed successfully")